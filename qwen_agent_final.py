@@ -1,32 +1,269 @@
 import os
 import json
 import base64
+import asyncio
+import math
+import random
+import hashlib
 import argparse
 
-from openai import OpenAI
+from collections import Counter, deque
+import fastjsonschema
+import httpx
+import orjson
+
+from io import BytesIO
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from PIL import Image
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from typing import List, Dict, Any, Tuple, Optional
 
-from playwright.sync_api import Page, sync_playwright
+from playwright.async_api import Browser, BrowserContext, Page, Playwright, async_playwright
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 # from xvfbwrapper import Xvfb
 
+VIEWPORT = {'width': 1280, 'height': 800}
+# Screenshots are downscaled to this size before being sent to the model, so the
+# coordinates the model returns are in this space and scaled back to the viewport.
+MODEL_IMAGE_SIZE = (960, 600)
+
+# Offsets (in model image pixels) tried around a click that left the page unchanged.
+CLICK_SWEEP_OFFSETS = [(0, -15), (15, 0), (0, 15), (-15, 0)]
+
+# Installs (once per document) a MutationObserver that sets window.__agentDomChanged,
+# then clears the flag, so the next step can tell whether an action changed the DOM.
+RESET_DOM_CHANGE_FLAG_JS = """() => {
+    if (!window.__agentDomObserver) {
+        window.__agentDomObserver = new MutationObserver(() => { window.__agentDomChanged = true; });
+        window.__agentDomObserver.observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+    }
+    window.__agentDomChanged = false;
+}"""
+
+async def reset_dom_change_flag(page: Page):
+    """Starts tracking DOM changes from now on; a failure just leaves the page looking changed."""
+    try:
+        await page.evaluate(RESET_DOM_CHANGE_FLAG_JS)
+    except Exception:
+        pass
+
+async def dom_changed(page: Page) -> bool:
+    """Whether the DOM changed since the last reset. A new document or a failed check counts as changed."""
+    try:
+        return await page.evaluate("() => window.__agentDomChanged !== false")
+    except Exception:
+        return True
+
+def next_sweep_click(recent_screens: deque, screen_hash: bytes) -> Optional[Tuple[Dict, str]]:
+    """
+    Returns the next offset retry of the model's most recent click and its reasoning
+    if the screen is unchanged since that click, or None once the offsets are used up.
+    recent_screens holds (screenshot hash, action, think, from_model) entries.
+    """
+    model_indices = [i for i, entry in enumerate(recent_screens) if entry[3]]
+    if not model_indices:
+        return None
+    origin_hash, origin_action, think_process, _ = recent_screens[model_indices[-1]]
+    # Every entry after the model's action is a sweep retry taken on the same screen.
+    sweeps_done = len(recent_screens) - 1 - model_indices[-1]
+    if (origin_hash != screen_hash or origin_action.get("action") != "click"
+            or sweeps_done >= len(CLICK_SWEEP_OFFSETS)):
+        return None
+
+    dx, dy = CLICK_SWEEP_OFFSETS[sweeps_done]
+    action_json = {
+        "action": "click",
+        "parameters": {
+            "x": origin_action["parameters"]["x"] + dx,
+            "y": origin_action["parameters"]["y"] + dy,
+            "comment": "Page unchanged after the last click, retrying nearby"
+        }
+    }
+    return action_json, think_process
+
+def _action_variant(name: str, parameters: Dict[str, Dict]) -> Dict:
+    """Schema for one action whose listed parameters are all required."""
+    variant = {"properties": {"action": {"const": name}}}
+    if parameters:
+        variant["required"] = ["parameters"]
+        variant["properties"]["parameters"] = {"type": "object", "required": list(parameters), "properties": parameters}
+    return variant
+
+# The action space described in the system prompt. Compiled once into a plain Python function.
+ACTION_SCHEMA = {
+    "type": "object",
+    "required": ["action"],
+    "properties": {"parameters": {"type": "object"}},
+    "oneOf": [
+        _action_variant("click", {"x": {"type": "number"}, "y": {"type": "number"}}),
+        _action_variant("type", {"text": {"type": "string"}}),
+        _action_variant("scroll", {"direction": {"enum": ["up", "down"]}}),
+        _action_variant("drag_and_drop", {
+            "source_x": {"type": "number"},
+            "source_y": {"type": "number"},
+            "target_x": {"type": "number"},
+            "target_y": {"type": "number"},
+        }),
+        _action_variant("finish", {}),
+    ],
+}
+validate_action = fastjsonschema.compile(ACTION_SCHEMA)
+
+# Tracker and ad hosts the agent never needs, including their subdomains. They fail
+# DNS resolution inside Chromium, so no request routing (which would disable the
+# HTTP cache) is needed to block them.
+BLOCKED_HOSTS = ("googletagmanager.com", "google-analytics.com", "doubleclick.net", "hotjar.com")
+BROWSER_ARGS = [
+    "--host-resolver-rules=" + ", ".join(f"MAP {host} ~NOTFOUND, MAP *.{host} ~NOTFOUND" for host in BLOCKED_HOSTS)
+]
+
+def bezier_drag_path(source: Tuple[float, float], target: Tuple[float, float], num_points: int = 25) -> List[Tuple[float, float]]:
+    """
+    Returns points along a randomly bent cubic Bezier curve from source to target,
+    with small jitter on the intermediate points, to make a drag look human.
+    """
+    (x0, y0), (x3, y3) = source, target
+    dx, dy = x3 - x0, y3 - y0
+    dist = math.hypot(dx, dy)
+    # Control points at roughly 1/3 and 2/3 of the way, pushed off the straight line by
+    # a few pixels at most so the pointer stays on a slider's track.
+    bend = random.uniform(-1, 1) * min(0.2 * dist, 8)
+    nx, ny = (-dy / dist, dx / dist) if dist else (0.0, 0.0)
+    x1, y1 = x0 + dx / 3 + nx * bend, y0 + dy / 3 + ny * bend
+    x2, y2 = x0 + 2 * dx / 3 + nx * bend, y0 + 2 * dy / 3 + ny * bend
+
+    points = []
+    for i in range(1, num_points + 1):
+        t = i / num_points
+        x = (1 - t) ** 3 * x0 + 3 * (1 - t) ** 2 * t * x1 + 3 * (1 - t) * t ** 2 * x2 + t ** 3 * x3
+        y = (1 - t) ** 3 * y0 + 3 * (1 - t) ** 2 * t * y1 + 3 * (1 - t) * t ** 2 * y2 + t ** 3 * y3
+        if i < num_points:
+            x += random.gauss(0, 1)
+            y += random.gauss(0, 1)
+        points.append((x, y))
+    return points
+
+def encode_screenshot(screenshot_bytes: bytes) -> str:
+    """Downscales a screenshot to the model input size and returns it as a base64 JPEG."""
+    image = Image.open(BytesIO(screenshot_bytes)).convert("RGB")
+    image = image.resize(MODEL_IMAGE_SIZE, Image.Resampling.BILINEAR)
+    buffer = BytesIO()
+    image.save(buffer, "JPEG", quality=60, optimize=True)
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+def create_openai_client(endpoint: str, api_key: str) -> AsyncOpenAI:
+    """
+    Creates an AsyncOpenAI client with a keep-alive connection pool large enough to be
+    shared by many concurrent sessions. Its connections belong to the running event loop.
+    """
+    http_client = DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=64, max_keepalive_connections=32))
+    return AsyncOpenAI(api_key=api_key, base_url=endpoint, http_client=http_client)
+
+class PageSettleWaiter:
+    """
+    Tracks a page's network activity from before an action so that its effects can be
+    awaited: a short minimum settle time, then until no request started since has been
+    in flight for quiet_ms, all capped at max_ms. If the main frame navigates, the new
+    document's domcontentloaded is awaited within the same cap.
+    """
+
+    def __init__(self, page: Page, min_ms: int = 200, quiet_ms: int = 500, max_ms: int = 3000):
+        self.page = page
+        self.min_ms = min_ms
+        self.quiet_ms = quiet_ms
+        self.max_ms = max_ms
+        self._in_flight = set()
+        self._navigated = False
+        self._last_activity = 0.0
+
+    def __enter__(self) -> "PageSettleWaiter":
+        self._last_activity = asyncio.get_running_loop().time()
+        self.page.on("request", self._on_request)
+        self.page.on("requestfinished", self._on_request_done)
+        self.page.on("requestfailed", self._on_request_done)
+        self.page.on("framenavigated", self._on_frame_navigated)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.page.remove_listener("request", self._on_request)
+        self.page.remove_listener("requestfinished", self._on_request_done)
+        self.page.remove_listener("requestfailed", self._on_request_done)
+        self.page.remove_listener("framenavigated", self._on_frame_navigated)
+
+    def _on_request(self, request):
+        self._in_flight.add(request)
+        self._last_activity = asyncio.get_running_loop().time()
+
+    def _on_request_done(self, request):
+        self._in_flight.discard(request)
+        self._last_activity = asyncio.get_running_loop().time()
+
+    def _on_frame_navigated(self, frame):
+        if frame == self.page.main_frame:
+            self._navigated = True
+
+    async def wait(self):
+        """Waits until the page has settled after the action, or the cap is reached."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_ms / 1000
+        await asyncio.sleep(self.min_ms / 1000)
+        while loop.time() < deadline:
+            if self._navigated:
+                self._navigated = False
+                try:
+                    await self.page.wait_for_load_state(
+                        "domcontentloaded", timeout=max(1, (deadline - loop.time()) * 1000)
+                    )
+                except PlaywrightTimeoutError:
+                    return
+                continue
+            if not self._in_flight and loop.time() - self._last_activity >= self.quiet_ms / 1000:
+                return
+            await asyncio.sleep(0.05)
+
+class RequestLimiter:
+    """
+    Throttles model requests across all sessions that share it: at most
+    max_concurrent requests in flight and, if rpm is set, request starts
+    spaced evenly to stay under rpm requests per minute. Without limits it is a no-op.
+    """
+
+    def __init__(self, max_concurrent: Optional[int] = None, rpm: Optional[int] = None):
+        self._semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent else None
+        self._interval = 60.0 / rpm if rpm else 0.0
+        self._lock = asyncio.Lock()
+        self._next_start = 0.0
+
+    async def __aenter__(self) -> "RequestLimiter":
+        if self._semaphore:
+            await self._semaphore.acquire()
+        try:
+            if self._interval:
+                async with self._lock:
+                    now = asyncio.get_running_loop().time()
+                    delay = self._next_start - now
+                    self._next_start = max(now, self._next_start) + self._interval
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        except BaseException:
+            if self._semaphore:
+                self._semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._semaphore:
+            self._semaphore.release()
+
 class QwenVLClient:
     """
     Handles communication with the Qwen-VL model and executes browser actions.
     This class acts as the 'worker' in the Orchestrator-Worker pattern.
     """
-    
-    def __init__(self, model: str, endpoint: str, api_key: str):
-        """Initializes the client to communicate with the Qwen model."""
-        self.model = model
-        self.client = OpenAI(api_key=api_key, base_url=endpoint)
-    
-    def get_response(self, screenshot_base64: str, task: str, url: str, trajectory: List, failure_info: Optional[str] = None) -> str:
-        """
-        Constructs a prompt and gets a response from the Qwen-VL model.
-        This version includes a comprehensive guide for solving various CAPTCHA types.
-        """
 
-        system_prompt = """
+    # Constant across calls, so the system message is built once per client.
+    # Includes a comprehensive guide for solving various CAPTCHA types.
+    _SYSTEM_PROMPT = """
         You are an expert web agent designed to navigate the web and overcome human verification challenges (CAPTCHAs).
         Analyze the user's goal, the current screenshot, and the action history to determine the next best action.
 
@@ -69,8 +306,46 @@ class QwenVLClient:
         ## Response Format
         First, provide your reasoning in a `<think>` tag. Then, output a single, clean JSON object for your chosen action.
         """
+    
+    # Number of most recent steps listed individually in the prompt history.
+    _HISTORY_WINDOW = 8
 
-        history_str = "\n".join(f"{i}: Executed {item['action']}" for i, item in enumerate(trajectory))
+    def __init__(
+        self,
+        model: str,
+        endpoint: str,
+        api_key: str,
+        human_like: bool = False,
+        request_limiter: Optional[RequestLimiter] = None,
+        client: Optional[AsyncOpenAI] = None,
+        vision_cache_key: bool = False,
+    ):
+        """
+        Initializes the client to communicate with the Qwen model.
+        If human_like is set, text is typed key by key with a delay instead of being inserted at once.
+        Passing the same request_limiter to several clients throttles their combined requests.
+        Passing the same client lets them share one connection pool; its owner closes it.
+        Without one, a client is created here and closed by close().
+        If vision_cache_key is set, each request carries a screenshot hash for servers
+        that cache vision features; other servers may reject or warn about the field.
+        """
+        self.model = model
+        self.human_like = human_like
+        self.vision_cache_key = vision_cache_key
+        self.coord_scale = (VIEWPORT['width'] / MODEL_IMAGE_SIZE[0], VIEWPORT['height'] / MODEL_IMAGE_SIZE[1])
+        self._system_msg = {"role": "system", "content": self._SYSTEM_PROMPT}
+        self.request_limiter = request_limiter or RequestLimiter()
+        self._owns_client = client is None
+        self.client = client or create_openai_client(endpoint, api_key)
+
+    async def close(self):
+        """Closes the AsyncOpenAI client if this instance created it."""
+        if self._owns_client:
+            await self.client.close()
+    
+    def build_messages(self, screenshot_base64: str, task: str, url: str, trajectory: List, failure_info: Optional[str] = None) -> List[Dict]:
+        """Constructs the chat messages for the Qwen-VL model."""
+        history_str = self._format_history(trajectory)
         
         user_prompt_content = f"""
         User Task: "{task}"
@@ -83,7 +358,7 @@ class QwenVLClient:
             user_prompt_content += f"\nIMPORTANT: Your last action failed with the error: '{failure_info}'. This might be because you are facing a CAPTCHA. Re-examine the screenshot, consult the CAPTCHA Solving Guide, and devise a new plan."
 
         messages = [
-            {"role": "system", "content": system_prompt},
+            self._system_msg,
             {
                 "role": "user",
                 "content": [
@@ -92,15 +367,166 @@ class QwenVLClient:
                 ]
             }
         ]
-        
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            max_tokens=1024,
-            temperature=0.0,
+        return messages
+
+    def _format_history(self, trajectory: List) -> str:
+        """
+        Formats the action history for the prompt: the most recent steps as compact
+        action(param=value) calls and a one-line summary of everything before them.
+        """
+        recent = trajectory[-self._HISTORY_WINDOW:]
+        older = trajectory[:len(trajectory) - len(recent)]
+
+        history_lines = []
+        if older:
+            counts = Counter(self._parse_history_action(item.get('action'))[0] for item in older)
+            summary = ", ".join(f"{count} {name}" for name, count in counts.items())
+            history_lines.append(f"Steps {older[0]['step']}-{older[-1]['step']}: {summary}")
+        for item in recent:
+            name, params = self._parse_history_action(item.get('action'))
+            args = ",".join(f"{k}={v}" for k, v in params.items() if k != 'comment')
+            line = f"{item['step']}: {name}({args})"
+            if item.get('auto_retry'):
+                line += " [automatic retry near your previous click; the page had not changed]"
+            history_lines.append(line)
+        return "\n".join(history_lines)
+
+    @staticmethod
+    def _parse_history_action(action_str: Optional[str]) -> Tuple[str, Dict]:
+        """Returns the action name and parameters of a trajectory entry's action JSON."""
+        try:
+            action = json.loads(action_str)
+        except (TypeError, json.JSONDecodeError):
+            return "unknown", {}
+        return str(action.get('action')), action.get('parameters') or {}
+
+    async def get_response(self, screenshot_base64: str, task: str, url: str, trajectory: List, failure_info: Optional[str] = None) -> str:
+        """
+        Constructs a prompt and streams a response from the Qwen-VL model.
+        Generation is cut off as soon as the action JSON is complete.
+        """
+        messages = self.build_messages(screenshot_base64, task, url, trajectory, failure_info)
+        extra_body = None
+        if self.vision_cache_key:
+            # Servers with vision feature caching skip the vision encoder when the key repeats,
+            # e.g. while the page is unchanged between CAPTCHA clicks.
+            image_key = hashlib.blake2b(screenshot_base64.encode('ascii'), digest_size=16).hexdigest()
+            extra_body = {"vision_cache_key": image_key}
+        async with self.request_limiter:
+            stream = await self._create_completion(
+                model=self.model,
+                messages=messages,
+                max_tokens=1024,
+                temperature=0.0,
+                extra_body=extra_body,
+                stream=True,
+            )
+
+            response_text = ""
+            try:
+                async for chunk in stream:
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    response_text += delta
+                    if "}" in delta and self._action_is_complete(response_text):
+                        break
+            finally:
+                # Closing the stream early aborts the rest of the generation on the server.
+                await stream.close()
+            return response_text
+
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=1, min=1, max=16),
+        retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)),
+        reraise=True,
+    )
+    async def _create_completion(self, **kwargs):
+        """Sends a chat completion request, retrying transient API errors with exponential backoff."""
+        # The SDK's own retries are disabled here so they do not multiply with the ones above.
+        return await self.client.with_options(max_retries=0).chat.completions.create(**kwargs)
+
+    @staticmethod
+    def _action_is_complete(response_text: str) -> bool:
+        """Returns True once the streamed text holds a closed top-level JSON object after the reasoning."""
+        if "<think>" in response_text:
+            if "</think>" not in response_text:
+                return False
+            response_text = response_text[response_text.find("</think>") + len("</think>"):]
+
+        json_start = response_text.find("{")
+        if json_start == -1:
+            return False
+        try:
+            json.JSONDecoder().raw_decode(response_text, json_start)
+            return True
+        except json.JSONDecodeError:
+            return False
+
+    def build_batch_request(self, custom_id: str, messages: List[Dict]) -> Dict:
+        """Wraps chat messages into a single Batch API request line."""
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": self.model,
+                "messages": messages,
+                "max_tokens": 1024,
+                "temperature": 0.0,
+            }
+        }
+
+    async def submit_batch(self, requests_jsonl_path: str, poll_interval: float = 30.0) -> Dict[str, Optional[str]]:
+        """
+        Submits a JSONL file of chat completion requests through the Batch API,
+        waits for the batch to complete and returns the response text keyed by custom_id.
+        """
+        with open(requests_jsonl_path, 'rb') as f:
+            batch_input = await self.client.files.create(file=f, purpose="batch")
+
+        batch = await self.client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
         )
-        return response.choices[0].message.content
+        print(f"Submitted batch {batch.id} from {requests_jsonl_path}")
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(poll_interval)
+            batch = await self.client.batches.retrieve(batch.id)
+            print(f"Batch {batch.id} status: {batch.status}")
+
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}' and no output file.")
+
+        output = await self.client.files.content(batch.output_file_id)
+        results = {}
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            body = (record.get("response") or {}).get("body") or {}
+            choices = body.get("choices") or []
+            results[record["custom_id"]] = choices[0]["message"]["content"] if choices else None
+        return results
     
+    def _to_viewport(self, x: float, y: float) -> Tuple[float, float]:
+        """Maps model image coordinates back to viewport coordinates."""
+        return x * self.coord_scale[0], y * self.coord_scale[1]
+
+    def to_viewport_action(self, action_data: Dict) -> Dict:
+        """
+        Returns a copy of the action with its coordinates mapped to the viewport, i.e. to
+        the saved full-size screenshot rather than the downscaled model image.
+        """
+        params = dict(action_data.get("parameters") or {})
+        for x_key, y_key in (('x', 'y'), ('source_x', 'source_y'), ('target_x', 'target_y')):
+            if x_key in params and y_key in params:
+                params[x_key], params[y_key] = self._to_viewport(params[x_key], params[y_key])
+        return {**action_data, "parameters": params}
+
     def parse_response(self, response_text: str) -> [Tuple, str]:
         """
         Parses the model's response to extract the <think> content and the action JSON.
@@ -114,20 +540,40 @@ class QwenVLClient:
             end = response_text.find("</think>")
             think_content = response_text[start:end].strip()
 
-        json_part = response_text
-        if "{" in response_text:
-            json_start = response_text.find("{")
-            json_end = response_text.rfind("}") + 1
-            json_part = response_text[json_start:json_end]
-        
+        # Prefer the text after </think> so example actions in the reasoning are not picked up.
+        action_json = None
+        if "</think>" in response_text:
+            action_json = self._find_json_object(response_text[response_text.find("</think>") + len("</think>"):])
+        if action_json is None:
+            action_json = self._find_json_object(response_text)
+
+        if action_json is None:
+            print(f"Failed to decode JSON from model response: {response_text}")
+            return None, think_content
+
         try:
-            action_json = json.loads(json_part)
-            return action_json, think_content
-        except json.JSONDecodeError:
-            print(f"Failed to decode JSON from model response: {json_part}")
+            validate_action(action_json)
+        except fastjsonschema.JsonSchemaException as e:
+            print(f"Model response is not a valid action ({e.message}): {action_json}")
             return None, think_content
+        return action_json, think_content
+
+    @staticmethod
+    def _find_json_object(text: str) -> Optional[Dict]:
+        """Returns the first complete JSON object in the text, or None if there is none."""
+        decoder = json.JSONDecoder()
+        idx = text.find("{")
+        while idx != -1:
+            try:
+                obj, _ = decoder.raw_decode(text, idx)
+                if isinstance(obj, dict):
+                    return obj
+            except json.JSONDecodeError:
+                pass
+            idx = text.find("{", idx + 1)
+        return None
     
-    def execute_action(self, action_data: Dict, page: Page) -> str:
+    async def execute_action(self, action_data: Dict, page: Page) -> str:
         """
         Executes the action determined by the model, now including a 'drag_and_drop' action.
         """
@@ -139,16 +585,32 @@ class QwenVLClient:
 
         print(f"Executing action '{action_name}' with params {params}")
 
+        if action_name == "finish":
+            return "finish"
+
+        with PageSettleWaiter(page) as settle_waiter:
+            await self._perform_action(action_name, params, page)
+            # Wait for the action's own requests and any navigation it started to finish,
+            # instead of sleeping a fixed interval.
+            await settle_waiter.wait()
+        return "continue"
+
+    async def _perform_action(self, action_name: str, params: Dict, page: Page):
+        """Dispatches a single non-finish action to the page."""
         if action_name == "click":
             if 'x' not in params or 'y' not in params:
                 raise ValueError("Action 'click' is missing required parameters: 'x' or 'y'.")
-            page.mouse.click(params['x'], params['y'])
+            x, y = self._to_viewport(params['x'], params['y'])
+            await page.mouse.click(x, y)
 
         elif action_name == "type":
             if 'text' not in params:
                 raise ValueError("Action 'type' is missing required parameter: 'text'.")
-            page.keyboard.type(params['text'], delay=100)
-            page.keyboard.press('Enter')
+            if self.human_like:
+                await page.keyboard.type(params['text'], delay=100)
+            else:
+                await page.keyboard.insert_text(params['text'])
+            await page.keyboard.press('Enter')
 
         elif action_name == "scroll":
             if 'direction' not in params:
@@ -157,127 +619,406 @@ class QwenVLClient:
             if direction not in ['up', 'down']:
                 raise ValueError(f"Invalid scroll direction: '{direction}'. Must be 'up' or 'down'.")
             delta_y = 500 if direction == 'down' else -500
-            page.mouse.wheel(0, delta_y)
+            await page.mouse.wheel(0, delta_y)
 
         elif action_name == "drag_and_drop":
             if not all(k in params for k in ['source_x', 'source_y', 'target_x', 'target_y']):
                 raise ValueError("Action 'drag_and_drop' is missing required coordinate parameters.")
             
+            source_x, source_y = self._to_viewport(params['source_x'], params['source_y'])
+            target_x, target_y = self._to_viewport(params['target_x'], params['target_y'])
+
             # Simulate a drag-and-drop action
-            page.mouse.move(params['source_x'], params['source_y'])
-            page.mouse.down()
-            # Move to the target with a few steps to appear more human-like
-            page.mouse.move(params['target_x'], params['target_y'], steps=5) 
-            page.mouse.up()
-            
-        elif action_name == "finish":
-            return "finish"
+            await page.mouse.move(source_x, source_y)
+            await page.mouse.down()
+            # Follow a curved, slightly jittery path with uneven timing; slider CAPTCHAs
+            # reject the straight, evenly spaced movement of a plain interpolated move.
+            for x, y in bezier_drag_path((source_x, source_y), (target_x, target_y)):
+                await page.mouse.move(x, y)
+                await asyncio.sleep(random.uniform(0.01, 0.03))
+            await page.mouse.up()
             
         else:
             raise ValueError(f"Unknown or improperly formatted action: {action_name}")
-        
-        # Action succeeded, wait for the page to stabilize.
-        page.wait_for_timeout(3000) # Increased timeout for CAPTCHA verification
-        return "continue"
 
-def browse(
+class BrowserPool:
+    """
+    Shares a warm Chromium instance across browsing sessions.
+    Each session gets its own isolated browser context, and at most
+    max_contexts contexts are open at any time. After max_uses contexts the
+    browser is recycled: new sessions go to a freshly launched browser and the
+    old one is closed once its last context is released, which bounds the
+    memory a long-lived Chromium process accumulates.
+    """
+
+    def __init__(self, max_contexts: int = 8, max_uses: int = 50, headless: bool = False):
+        self.max_contexts = max_contexts
+        self.max_uses = max_uses
+        self.headless = headless # Set to True for no GUI
+        self._semaphore = asyncio.Semaphore(max_contexts)
+        self._lock = asyncio.Lock()
+        self._playwright: Optional[Playwright] = None
+        self._browser: Optional[Browser] = None
+        self._uses = 0
+        self._retired: List[Browser] = []
+
+    async def start(self):
+        """Starts Playwright and pre-launches the shared browser."""
+        self._playwright = await async_playwright().start()
+        self._browser = await self._launch()
+        self._uses = 0
+
+    async def _launch(self) -> Browser:
+        """Launches a Chromium instance with tracker hosts blocked."""
+        return await self._playwright.chromium.launch(headless=self.headless, args=BROWSER_ARGS)
+
+    async def close(self):
+        """Closes all browsers and stops Playwright."""
+        for browser in self._retired + ([self._browser] if self._browser else []):
+            await browser.close()
+        self._retired = []
+        self._browser = None
+        if self._playwright:
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def __aenter__(self) -> "BrowserPool":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _recycle(self):
+        """Swaps in a fresh browser, retiring the current one until its contexts are released."""
+        old_browser = self._browser
+        self._browser = await self._launch()
+        self._uses = 0
+        if old_browser.contexts:
+            self._retired.append(old_browser)
+        else:
+            await old_browser.close()
+
+    async def acquire_context(self, **context_options) -> BrowserContext:
+        """Waits for a free slot and opens a new context on the warm browser."""
+        await self._semaphore.acquire()
+        try:
+            async with self._lock:
+                if self._uses >= self.max_uses:
+                    await self._recycle()
+                self._uses += 1
+                return await self._browser.new_context(**context_options)
+        except Exception:
+            self._semaphore.release()
+            raise
+
+    async def release_context(self, context: BrowserContext):
+        """Closes a browser context, frees its slot and shuts down a drained retired browser."""
+        browser = context.browser
+        try:
+            await context.close()
+            if browser in self._retired and not browser.contexts:
+                self._retired.remove(browser)
+                await browser.close()
+        finally:
+            self._semaphore.release()
+
+async def browse(
     start_url: str, 
     task: str, 
     model: str,
     endpoint: str,
     api_key: str,
     max_steps: int = 30,
+    batch_file: Optional[str] = None,
+    session_id: str = "0",
+    pool: Optional["BrowserPool"] = None,
+    screenshot_dir: str = "screenshots",
+    human_like: bool = False,
+    request_limiter: Optional[RequestLimiter] = None,
+    log_file: Optional[str] = None,
+    openai_client: Optional[AsyncOpenAI] = None,
+    vision_cache_key: bool = False,
 ) -> List:
     """
     Perform web browsing session. This function is the 'Orchestrator'.
+    If batch_file is given, the step prompt is appended to it as a Batch API
+    request instead of being sent to the endpoint.
+    The session runs in its own context of the pool's browser; without a pool,
+    a single-context pool is started for this session only.
+    Screenshots are written to screenshot_dir and referenced by path in the trajectory.
+    Each step's "action" is in the model's downscaled image coordinates, while
+    "viewport_action" holds the same action in the saved screenshot's coordinates.
+    If log_file is given, every step is also appended to it as a JSON line as soon
+    as it is recorded, so a crashed session can still be recovered.
+    An openai_client passed in is shared and left open; otherwise the session creates
+    and closes its own.
     """
-    qwen_client = QwenVLClient(model, endpoint, api_key)
+    qwen_client = QwenVLClient(
+        model, endpoint, api_key, human_like=human_like, request_limiter=request_limiter, client=openai_client,
+        vision_cache_key=vision_cache_key,
+    )
+    os.makedirs(screenshot_dir, exist_ok=True)
     trajectory = []
+    # (screenshot hash, action, think, from_model) of recently executed actions, used to
+    # retry clicks that left the page unchanged without asking the model again. Sized to
+    # hold the model's click plus one retry per sweep offset.
+    recent_screens = deque(maxlen=len(CLICK_SWEEP_OFFSETS) + 1)
     failure_reason = None
     is_finished = False
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=False) # Set to True for no GUI
-        page = browser.new_page(viewport={'width': 1280, 'height': 800})
-        
-        try:
-            page.goto(start_url, wait_until="domcontentloaded")
+    log_fh = None
 
-            for step in range(1, max_steps + 1):
-                if is_finished:
-                    break
-                
-                print(f"\n--- Step {step}/{max_steps} ---")
-                
-                try:
-                    page.wait_for_load_state("domcontentloaded", timeout=10000)
-                    screenshot_bytes = page.screenshot(type="jpeg", quality=80)
-                    screenshot_base64 = base64.b64encode(screenshot_bytes).decode('utf-8')
+    def record_step(entry: Dict):
+        """Adds a step to the trajectory and flushes it to the step log."""
+        trajectory.append(entry)
+        if log_fh:
+            log_fh.write(orjson.dumps(entry) + b"\n")
+            log_fh.flush()
 
-                    response_text = qwen_client.get_response(screenshot_base64, task, page.url, trajectory, failure_reason)
-                    failure_reason = None # Reset after using it
+    own_pool = pool is None
+    context = None
+    try:
+        if log_file:
+            log_fh = open(log_file, 'wb')
+        if own_pool:
+            pool = BrowserPool(max_contexts=1)
+            await pool.start()
+        context = await pool.acquire_context(viewport=VIEWPORT)
+        page = await context.new_page()
+        await page.goto(start_url, wait_until="domcontentloaded")
 
-                    action_json, think_process = qwen_client.parse_response(response_text)
-                    if not action_json:
-                        raise ValueError("Failed to parse a valid action from the model's response.")
+        for step in range(1, max_steps + 1):
+            if is_finished:
+                break
+            
+            print(f"\n--- Step {step}/{max_steps} ---")
+            screenshot_path = os.path.join(screenshot_dir, f"step_{step}.jpg")
+            screenshot_bytes = None
+            
+            try:
+                screenshot_bytes = await page.screenshot(path=screenshot_path, type="jpeg", quality=60)
+                screen_hash = hashlib.blake2b(screenshot_bytes, digest_size=8).digest()
+                sweep = None
+                if not batch_file and failure_reason is None:
+                    sweep = next_sweep_click(recent_screens, screen_hash)
+                    # Identical pixels alone are not enough: the click may have changed the DOM
+                    # without a visible difference, e.g. a submit still waiting on the server.
+                    if sweep and await dom_changed(page):
+                        sweep = None
 
-                    action_result_str = json.dumps(action_json)
-                    trajectory.append({
+                if sweep:
+                    # Neither the pixels nor the DOM changed after the last click; rather than
+                    # asking the model the same question again, retry its click slightly offset.
+                    action_json, think_process = sweep
+                    await page.wait_for_load_state("domcontentloaded", timeout=10000)
+                    record_step({
                         "step": step,
-                        "screenshot": screenshot_base64,
+                        "screenshot_path": screenshot_path,
                         "think": think_process,
-                        "action": action_result_str
+                        "action": json.dumps(action_json),
+                        "viewport_action": json.dumps(qwen_client.to_viewport_action(action_json)),
+                        "auto_retry": True
                     })
+                    recent_screens.append((screen_hash, action_json, think_process, False))
+
+                    await reset_dom_change_flag(page)
+                    await qwen_client.execute_action(action_json, page)
+                    continue
+
+                # Resizing and encoding are CPU-bound; keep them off the event loop shared by all sessions.
+                screenshot_base64 = await asyncio.to_thread(encode_screenshot, screenshot_bytes)
 
-                    status = qwen_client.execute_action(action_json, page)
-                    if status == "finish":
-                        print("Task finished successfully.")
-                        is_finished = True
-
-                except Exception as e:
-                    print(f"An error occurred in step {step}: {e}")
-                    failure_reason = str(e) # This implements the Evaluator-Optimizer feedback loop
-                    # Log the failure and continue to the next step to allow self-correction
-                    if 'screenshot_base64' not in locals():
-                        screenshot_bytes = page.screenshot(type="jpeg", quality=80)
-                        screenshot_base64 = base64.b64encode(screenshot_bytes).decode('utf-8')
-                    
-                    trajectory.append({
+                if batch_file:
+                    # Without a response there is no action to execute, so the
+                    # session ends once its prompt has been queued for the batch.
+                    custom_id = f"{session_id}:{step}"
+                    messages = qwen_client.build_messages(screenshot_base64, task, page.url, trajectory, failure_reason)
+                    with open(batch_file, 'a') as f:
+                        f.write(json.dumps(qwen_client.build_batch_request(custom_id, messages)) + "\n")
+                    record_step({
                         "step": step,
-                        "screenshot": screenshot_base64,
-                        "think": f"Action failed with error: {e}",
-                        "action": f'{{"action": "error", "parameters": {{"message": "{str(e)}"}} }}'
+                        "screenshot_path": screenshot_path,
+                        "custom_id": custom_id
                     })
-        
-        finally:
-            if not is_finished:
-                print("Max steps reached. Task may be incomplete.")
-            browser.close()
+                    is_finished = True
+                    break
+
+                # Dispatch the model call immediately and let the page finish loading
+                # from the previous action while the request is in flight.
+                response_task = asyncio.create_task(
+                    qwen_client.get_response(screenshot_base64, task, page.url, trajectory, failure_reason)
+                )
+                load_task = asyncio.create_task(page.wait_for_load_state("domcontentloaded", timeout=10000))
+                try:
+                    response_text, _ = await asyncio.gather(response_task, load_task)
+                except Exception:
+                    response_task.cancel()
+                    load_task.cancel()
+                    # Let the cancelled tasks finish so an in-flight stream is closed.
+                    await asyncio.gather(response_task, load_task, return_exceptions=True)
+                    raise
+                failure_reason = None # Reset after using it
+
+                action_json, think_process = qwen_client.parse_response(response_text)
+                if not action_json:
+                    raise ValueError("Failed to parse a valid action from the model's response.")
+
+                action_result_str = json.dumps(action_json)
+                record_step({
+                    "step": step,
+                    "screenshot_path": screenshot_path,
+                    "think": think_process,
+                    "action": action_result_str,
+                    "viewport_action": json.dumps(qwen_client.to_viewport_action(action_json))
+                })
+                recent_screens.append((screen_hash, action_json, think_process, True))
+
+                if action_json.get("action") == "click":
+                    await reset_dom_change_flag(page)
+                status = await qwen_client.execute_action(action_json, page)
+                if status == "finish":
+                    print("Task finished successfully.")
+                    is_finished = True
+
+            except Exception as e:
+                print(f"An error occurred in step {step}: {e}")
+                failure_reason = str(e) # This implements the Evaluator-Optimizer feedback loop
+                # Log the failure and continue to the next step to allow self-correction
+                # Only capture when the step failed before its own screenshot was taken.
+                if screenshot_bytes is None:
+                    try:
+                        await page.screenshot(
+                            path=screenshot_path,
+                            type="jpeg",
+                            quality=60,
+                            clip={'x': 0, 'y': 0, 'width': VIEWPORT['width'], 'height': VIEWPORT['height']},
+                        )
+                    except Exception as screenshot_error:
+                        # The step's own capture most likely failed the same way; keep the
+                        # session going and let the model react to the error.
+                        print(f"Could not capture a screenshot for step {step}: {screenshot_error}")
+                        screenshot_path = None
+                
+                record_step({
+                    "step": step,
+                    "screenshot_path": screenshot_path,
+                    "think": f"Action failed with error: {e}",
+                    "action": json.dumps({"action": "error", "parameters": {"message": str(e)}})
+                })
     
+    finally:
+        if not is_finished:
+            print("Max steps reached. Task may be incomplete.")
+        if log_fh:
+            log_fh.close()
+        if context:
+            await pool.release_context(context)
+        if own_pool:
+            await pool.close()
+        await qwen_client.close()
+
     return trajectory
 
+def apply_batch_results(qwen_client: QwenVLClient, trajectory: List, responses: Dict[str, Optional[str]]):
+    """Fills in the think/action fields of batched trajectory steps from the Batch API responses."""
+    for item in trajectory:
+        custom_id = item.get("custom_id")
+        if custom_id is None:
+            continue
+        action_json, think_process = qwen_client.parse_response(responses.get(custom_id))
+        item["think"] = think_process
+        item["action"] = json.dumps(action_json) if action_json else None
+        item["viewport_action"] = json.dumps(qwen_client.to_viewport_action(action_json)) if action_json else None
+
 def save_results(url: str, task: str, trajectory: List, output_file: str):
-    """Saves the browsing session trajectory to a JSON file."""
+    """
+    Saves the browsing session trajectory to a JSON file.
+    If the session never returned its trajectory, the steps are recovered from the
+    <output_file>.jsonl step log. The file is replaced atomically and the log removed.
+    """
+    log_file = output_file + ".jsonl"
+    if not trajectory and os.path.exists(log_file):
+        with open(log_file, 'rb') as f:
+            trajectory = [orjson.loads(line) for line in f if line.strip()]
+
     output_data = {
         "url": url,
         "task": task,
         "trajectory": trajectory
     }
-    with open(output_file, 'w') as f:
-        json.dump(output_data, f, indent=2)
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(orjson.dumps(output_data, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_file, output_file)
+    if os.path.exists(log_file):
+        os.remove(log_file)
     print(f"Trajectory saved to {output_file}")
 
 def parse_arguments() -> argparse.Namespace:
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description='Web browsing agent using Qwen-VL')
-    parser.add_argument('--url', type=str, required=True, help='Starting URL for the browsing session')
-    parser.add_argument('--task', type=str, required=True, help='Task description/intent for the agent')
-    parser.add_argument('--output', type=str, default='output.json', help='Output file path for results (default: results.json)')
+    parser.add_argument('--url', type=str, help='Starting URL for the browsing session')
+    parser.add_argument('--task', type=str, help='Task description/intent for the agent')
+    parser.add_argument('--tasks', type=str, help='JSON file with a list of {"url", "task"} objects to run concurrently instead of --url/--task')
+    parser.add_argument('--output', type=str, default='output.json', help='Output file path for results; indexed per task with --tasks (default: output.json)')
     parser.add_argument('--max-steps', type=int, default=30, help='Maximum number of browsing steps (default: 30)')
     parser.add_argument('--model', type=str, default='Qwen/Qwen2.5-VL-72B-Instruct-AWQ', help='Model to use for the agent')
     parser.add_argument('--endpoint', type=str, required=True, help='API endpoint for model inference')
+    parser.add_argument('--max-concurrent-requests', type=int, default=None, help='Maximum number of model requests in flight across all sessions; each session has at most one, so this only has an effect below --max-concurrency (default: no limit)')
+    parser.add_argument('--rpm', type=int, default=None, help='Maximum number of model requests per minute across all sessions (default: unlimited)')
+    parser.add_argument('--human-like', action='store_true', help='Type text key by key with a 100 ms delay instead of inserting it at once')
+    parser.add_argument('--vision-cache-key', action='store_true', help='Send a screenshot hash as vision_cache_key for servers that cache vision features (rejected by the OpenAI API)')
+    parser.add_argument('--batch', action='store_true', help='Submit step prompts through the Batch API instead of running interactively')
+    parser.add_argument('--max-concurrency', type=int, default=8, help='Maximum number of concurrent browser contexts with --tasks (default: 8)')
+    parser.add_argument('--browser-max-uses', type=int, default=50, help='Number of sessions served by a browser before it is recycled (default: 50)')
     
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not args.tasks and not (args.url and args.task):
+        parser.error("either --tasks or both --url and --task are required")
+    return args
+
+async def run_tasks(tasks: List[Dict], trajectories: List[List], output_files: List[str], args: argparse.Namespace, api_key: str, batch_file: Optional[str] = None):
+    """
+    Runs every task concurrently in its own context of a shared browser,
+    storing each trajectory at the task's index in trajectories.
+    Screenshots of each task go to a directory named after its output file.
+    """
+    async def run_one(index: int, item: Dict):
+        try:
+            trajectories[index] = await browse(
+                start_url=item["url"],
+                task=item["task"],
+                model=args.model,
+                endpoint=args.endpoint,
+                api_key=api_key,
+                max_steps=args.max_steps,
+                batch_file=batch_file,
+                session_id=str(index),
+                pool=pool,
+                screenshot_dir=os.path.splitext(output_files[index])[0] + "_screenshots",
+                human_like=args.human_like,
+                vision_cache_key=args.vision_cache_key,
+                request_limiter=request_limiter,
+                log_file=output_files[index] + ".jsonl",
+                openai_client=openai_client,
+            )
+        except Exception as e:
+            print(f"A critical error occurred during the browsing session for task #{index}: {e}")
+
+    request_limiter = RequestLimiter(max_concurrent=args.max_concurrent_requests, rpm=args.rpm)
+    openai_client = create_openai_client(args.endpoint, api_key)
+    try:
+        async with BrowserPool(max_contexts=args.max_concurrency, max_uses=args.browser_max_uses) as pool:
+            await asyncio.gather(*[run_one(i, item) for i, item in enumerate(tasks)])
+
+        if batch_file and any(trajectories):
+            qwen_client = QwenVLClient(args.model, args.endpoint, api_key, client=openai_client)
+            responses = await qwen_client.submit_batch(batch_file)
+            for trajectory in trajectories:
+                apply_batch_results(qwen_client, trajectory, responses)
+    finally:
+        await openai_client.close()
 
 def main() -> None:
     """Main entry point."""
@@ -287,20 +1028,28 @@ def main() -> None:
     # vdisplay = Xvfb()
     # vdisplay.start()
     
-    trajectory = []
+    if args.tasks:
+        with open(args.tasks, 'r') as f:
+            tasks = json.load(f)
+        output_stem, output_ext = os.path.splitext(args.output)
+        output_files = [f"{output_stem}_{i}{output_ext}" for i in range(len(tasks))]
+    else:
+        tasks = [{"url": args.url, "task": args.task}]
+        output_files = [args.output]
+
+    batch_file = None
+    if args.batch:
+        batch_file = os.path.splitext(args.output)[0] + "_batch_requests.jsonl"
+        open(batch_file, 'w').close()
+
+    trajectories = [[] for _ in tasks]
     try:
-        trajectory = browse(
-            start_url=args.url,
-            task=args.task,
-            model=args.model,
-            endpoint=args.endpoint,
-            api_key=api_key,
-            max_steps=args.max_steps,
-        )
+        asyncio.run(run_tasks(tasks, trajectories, output_files, args, api_key, batch_file))
     except Exception as e:
         print(f"A critical error occurred during the browsing session: {e}")
     finally:
-        save_results(args.url, args.task, trajectory, args.output)
+        for item, trajectory, output_file in zip(tasks, trajectories, output_files):
+            save_results(item["url"], item["task"], trajectory, output_file)
     #     vdisplay.stop()
 
 if __name__ == "__main__":